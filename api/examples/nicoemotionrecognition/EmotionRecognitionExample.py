@@ -58,6 +58,13 @@ parser.add_argument(
     "--disable-gui", dest="gui", action="store_false", help="Disables the GUI."
 )
 
+parser.add_argument(
+    "--backend",
+    choices=("keras", "tflite", "onnx"),
+    default="keras",
+    help="Inference backend for the emotion model (default is keras)",
+)
+
 args = parser.parse_args()
 
 robot = None
@@ -76,7 +83,12 @@ if "See3CAM" in camera_path:
     camera.zoom(300)
 
 emotionRecogniton = EmotionRecognition.EmotionRecognition(
-    device=camera, robot=robot, face=face, voiceEnabled=args.voice, german=args.german
+    device=camera,
+    robot=robot,
+    face=face,
+    voiceEnabled=args.voice,
+    german=args.german,
+    backend=args.backend,
 )
 
 emotionRecogniton.start(showGUI=args.gui, faceTracking=args.motion, mirrorEmotion=True)
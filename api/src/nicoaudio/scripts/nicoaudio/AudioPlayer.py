@@ -187,7 +187,7 @@ class AudioPlayer(object):
         :param percentage: Volume [0.0, 1.0]
         :type percentage: float
         """
-        if self._thread is None:
+        if self._thread is None or not self._thread.is_alive():
             self.volume = volume
             self._thread = threading.Thread(target=self._playback)
             self._pos = 0
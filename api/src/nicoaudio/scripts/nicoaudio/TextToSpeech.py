@@ -68,6 +68,32 @@ class TextToSpeech(object):
         :return: Playback duration left (0 if blocking)
         :rtype: float
         """
+        playback = self.load(text, language, pitch, speed)
+        playback.play()
+        if blocking:
+            time.sleep(playback.duration)
+        return playback.duration - playback.position
+
+    def load(self, text, language="en-GB", pitch=0, speed=1.0):
+        """
+        Generates spoken text like :meth:`say` without playing it. The
+        returned AudioPlayer can be (re)played later without generating the
+        audio again.
+
+        :param text: text to speak
+        :type text: str
+        :param language: Language code (e.g. 'en-GB' or 'de')
+        :type language: str
+        :param pitch: Pitch in octaves by which to shift the output
+                      (this affects the speed)
+        :type pitch: float
+        :param speed: Percentage to increase/decrease speed without changing
+                      pitch
+        :type speed: float
+
+        :return: AudioPlayer with the generated audio
+        :rtype: nicoaudio.AudioPlayer.AudioPlayer
+        """
         # try to use mozilla tts server
         tts_server_online = False
         if language.startswith("en"):
@@ -144,13 +170,9 @@ class TextToSpeech(object):
                 )
                 raise
 
-        # play audio file
         playback.pitch(pitch)
         playback.speed(speed)
-        playback.play()
-        if blocking:
-            time.sleep(playback.duration)
-        return playback.duration - playback.position
+        return playback
 
 
 if __name__ == "__main__":
@@ -80,6 +80,20 @@ class AudioPlayerTest(unittest.TestCase):
         player.pause()
         self.assertAlmostEqual(player.position, 5.0, delta=0.2)
 
+    def test_replay(self):
+        """tests if play restarts playback after the end was reached"""
+        generate_audio_file("/tmp/NICO_test_replay.wav", duration=1.0)
+        player = AudioPlayer.AudioPlayer("/tmp/NICO_test_replay.wav")
+        # play until the end
+        player.play()
+        time.sleep(1.5)
+        self.assertAlmostEqual(player.position, 1.0, delta=0.2)
+        # play again and check if it started from the beginning
+        player.play()
+        time.sleep(0.5)
+        player.pause()
+        self.assertAlmostEqual(player.position, 0.5, delta=0.2)
+
     def test_pitch(self):
         """Tests pitch shifting"""
         generate_audio_file("/tmp/NICO_test_pitch.wav")
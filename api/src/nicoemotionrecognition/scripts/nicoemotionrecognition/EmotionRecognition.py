@@ -3,14 +3,19 @@
 
 import logging
 import random
+import threading
 import time
 
 import cv2
 import numpy
-import tensorflow as tf
 from nicovision.VideoDevice import VideoDevice
 from nicoaudio.TextToSpeech import TextToSpeech
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 from ._nicoemotionrecognition_internal import (
     GUIController,
     imageProcessingUtil,
@@ -87,6 +92,9 @@ class EmotionRecognition:
             ),
         },
     }
+    # emotions that are reported instead of the most likely one if their score
+    # exceeds the threshold (in order of priority)
+    _emotion_thresholds = (("Fear", 15), ("Anger", 20), ("Sadness", 15))
 
     def __init__(
         self,
@@ -96,6 +104,7 @@ class EmotionRecognition:
         faceDetectionDelta=10,
         voiceEnabled=False,
         german=False,
+        backend="keras",
     ):
         """
         Initialises the EmotionRecognition
@@ -107,12 +116,19 @@ class EmotionRecognition:
         :param face: FaceExpression object to mirror emotions
         :type face: nicoface.FaceExpression
         :param faceDetectionDelta: Number of frames until face detection is
-                                   refreshed
+                                   refreshed while a face is visible
+                                   (detection runs every frame otherwise)
         :type faceDetectionDelta: int
         :param voiceEnabled: enables voice feedback based on detected emotions
         :type voiceEnabled: bool
         :param german: switch audio from english to german
         :type german: bool
+        :param backend: Inference backend for the emotion model - "keras",
+                        "tflite" (requires a quantized model, see
+                        api/utility/quantize_emotion_model.py) or "onnx"
+                        (requires onnxruntime and an exported model, see
+                        api/utility/export_emotion_model_onnx.py)
+        :type backend: str
         """
         self._logger = logging.getLogger(__name__)
         self._finalImageSize = (
@@ -137,15 +153,26 @@ class EmotionRecognition:
         if voiceEnabled:
             self._tts = TextToSpeech()
             self._tts_end = 0
+            # generated voice lines by sentence - guarded by the lock, since
+            # TextToSpeech is not thread-safe
+            self._voice_lines = {}
+            self._voice_lines_lock = threading.Lock()
         self._german = german
+        self._reactions = self._voice_reactions["german" if german else "english"]
 
         self._modelCategorical = modelLoader.modelLoader(
-            modelDictionary.CategoricaModel
+            modelDictionary.CategoricaModel, backend
         )
         # self._modelDimensional = modelLoader.modelLoader(
-        #     modelDictionary.DimensionalModel
+        #     modelDictionary.DimensionalModel, backend
         # )
-        self._graph = tf.get_default_graph()
+        classes = self._modelCategorical.modelDictionary.classsesOrder
+        self._thresholdIndices = numpy.array(
+            [classes.index(emotion) for emotion, _ in self._emotion_thresholds]
+        )
+        self._thresholds = numpy.array(
+            [threshold for _, threshold in self._emotion_thresholds]
+        )
 
         self._faceDetectionDelta = faceDetectionDelta
         self._imageProcessing = imageProcessingUtil.imageProcessingUtil(
@@ -194,10 +221,42 @@ class EmotionRecognition:
         self._faceTracking = faceTracking
         self._trackingDelta = trackingDelta
         self._trackingCounter = trackingDelta
-        self._device.add_callback(self._callback)
-        self._device.open()
+        # expression currently shown on the face
+        self._shown_exp = None
         self._showGUI = showGUI
+        if showGUI:
+            # reused for every frame
+            self._canvas = numpy.zeros(
+                (self._finalImageSize[1], self._finalImageSize[0], 3), numpy.uint8
+            )
+            # pollKey (OpenCV >= 4.5) handles window events without waiting
+            if hasattr(cv2, "pollKey"):
+                self._pollKey = cv2.pollKey
+            else:
+                self._pollKey = lambda: cv2.waitKey(1)
+        # pipeline: camera callback (detection) -> inference -> post processing
+        # (motion, face, voice and GUI), connected by single slot queues that
+        # only hold the latest frame
+        self._preQueue = queue.Queue(maxsize=1)
+        self._postQueue = queue.Queue(maxsize=1)
         self._running = True
+        self._threads = [
+            threading.Thread(target=self._infer_loop),
+            threading.Thread(target=self._post_loop),
+        ]
+        if self._voiceEnabled:
+            self._ttsQueue = queue.Queue(maxsize=1)
+            self._threads.append(threading.Thread(target=self._tts_loop))
+        for thread in self._threads:
+            thread.start()
+        if self._voiceEnabled:
+            # not joined in stop - generating a voice line waits on the
+            # network, which would block stopping for an unbounded time
+            preloader = threading.Thread(target=self._preload_voice_lines)
+            preloader.daemon = True
+            preloader.start()
+        self._device.add_callback(self._callback)
+        self._device.open()
 
     def stop(self):
         """
@@ -210,10 +269,13 @@ class EmotionRecognition:
             return
         self._device.close()
         self._device = None
+        self._running = False
+        for thread in self._threads:
+            thread.join()
         self._categoricalRecognition = None
         self._dimensionalRecognition = None
+        self._canvas = None
         cv2.destroyAllWindows()
-        self._running = False
 
     def getDimensionalData(self):
         """
@@ -231,12 +293,11 @@ class EmotionRecognition:
         if self._dimensionalRecognition is None:
             self._logger.info("No face detected - Dimensional data will be 'None'")
             return None
+        values = numpy.asarray(self._dimensionalRecognition, dtype=numpy.float32)
         return dict(
             zip(
                 self._modelDimensional.modelDictionary.classsesOrder,
-                map(
-                    lambda x: float(float(x[0][0]) * 100), self._dimensionalRecognition
-                ),
+                (values.ravel() * 100.0).tolist(),
             )
         )
 
@@ -273,21 +334,29 @@ class EmotionRecognition:
                  Contempt (or None if no face detected)
         :rtype: String
         """
-        if self._categoricalRecognition is not None:
-
-            if self._categoricalRecognition[0][6] > 15:
-                return "fear"
-            elif self._categoricalRecognition[0][4] > 20:
-                return "anger"
-            elif self._categoricalRecognition[0][3] > 15:
-                return "sadness"
-            elif self._categoricalRecognition[0][3] > 20:
-                return "happiness"
-            return self._modelCategorical.modelDictionary.classsesOrder[
-                numpy.argmax(self._categoricalRecognition[0])
-            ].lower()
+        categoricalRecognition = self._categoricalRecognition
+        if categoricalRecognition is not None:
+            return self._highest_matching_emotion(categoricalRecognition)
         return None
 
+    def _highest_matching_emotion(self, categoricalRecognition):
+        """
+        Returns the name of the highest matching emotion for the given
+        classification result
+
+        :param categoricalRecognition: classification result for a face
+        :type categoricalRecognition: numpy.ndarray
+        :return: Neutral, Happiness, Surprise, Sadness, Anger, Disgust, Fear or
+                 Contempt
+        :rtype: String
+        """
+        scores = categoricalRecognition[0]
+        classes = self._modelCategorical.modelDictionary.classsesOrder
+        exceeded = numpy.flatnonzero(scores[self._thresholdIndices] > self._thresholds)
+        if exceeded.size:
+            return classes[self._thresholdIndices[exceeded[0]]].lower()
+        return classes[scores.argmax()].lower()
+
     def say(self, sen, delay=5):
         """
         Triggers tts module to play the given sentence and updates internal
@@ -298,13 +367,37 @@ class EmotionRecognition:
         :param delay: delay in seconds until another voice line will be played
         :type delay: float
         """
-        if self._german:
-            duration = self._tts.say(
-                sen, language="de", blocking=False, pitch=0.2, speed=2 ** -0.2
-            )
-        else:
-            duration = self._tts.say(sen, blocking=False, pitch=0.2, speed=2 ** -0.2)
-        self._tts_end = time.time() + duration + delay
+        playback = self._voice_line(sen)
+        playback.play()
+        self._tts_end = time.time() + playback.duration + delay
+
+    def _voice_line(self, sen):
+        """
+        Returns the audio for the given sentence, generating it if necessary
+
+        :param sen: the sentence
+        :type sen: str
+        :return: generated audio
+        :rtype: nicoaudio.AudioPlayer.AudioPlayer
+        """
+        with self._voice_lines_lock:
+            if sen not in self._voice_lines:
+                language = "de" if self._german else "en-GB"
+                self._voice_lines[sen] = self._tts.load(
+                    sen, language=language, pitch=0.2, speed=2 ** -0.2
+                )
+            return self._voice_lines[sen]
+
+    def _preload_voice_lines(self):
+        """
+        Generates all voice reactions in the background, so that they can be
+        played without delay once an emotion is detected.
+        """
+        for sentences in self._reactions.values():
+            for sen in sentences:
+                if not self._running:
+                    return
+                self._voice_line(sen)
 
     def voice_reaction(self, emotion):
         """
@@ -313,10 +406,25 @@ class EmotionRecognition:
         :param emotion: detected emotion
         :type emotion: str
         """
-        language = "german" if self._german else "english"
-        if emotion in self._voice_reactions[language]:
-            sentences = self._voice_reactions[language][emotion]
-            self.say(random.choice(sentences))
+        sentences = self._reactions.get(emotion)
+        if sentences:
+            self._queue_sentence(random.choice(sentences))
+
+    def _queue_sentence(self, sen, delay=5):
+        """
+        Queues the given sentence for the tts thread, so that the calling
+        thread is not blocked by speech synthesis (plays it directly if the
+        emotion recognition is not running)
+
+        :param sen: the next sentence
+        :type sen: str
+        :param delay: delay in seconds until another voice line will be played
+        :type delay: float
+        """
+        if self._running:
+            self._put_latest(self._ttsQueue, (sen, delay))
+        else:
+            self.say(sen, delay)
 
     def follow_face_with_head(self, facePoints):
         """
@@ -327,11 +435,13 @@ class EmotionRecognition:
         """
         if self._robot is not None:
             if self._trackingCounter == self._trackingDelta:
-                # (width - center_x)/width * FOV - FOV/2
+                center = facePoints["center"]
+                # (width - center_x)/width * FOV - FOV/2, with FOV/width and
+                # FOV/2 written as constants that are folded at compile time
                 # horizontal
-                angle_z = (640 - facePoints["center"].x) / 640.0 * 60 - 60 / 2.0
+                angle_z = (640 - center.x) * (60 / 640.0) - 60 / 2.0
                 # vertikal
-                angle_y = (480 - facePoints["center"].y) / 480.0 * 50 - 50 / 2.0
+                angle_y = (480 - center.y) * (50 / 480.0) - 50 / 2.0
                 self._robot.changeAngle("head_z", angle_z, 0.02)
                 self._robot.changeAngle("head_y", -angle_y, 0.02)
                 self._trackingCounter = 0
@@ -356,11 +466,22 @@ class EmotionRecognition:
         else:
             self._same_emotion_counter += 1
             if self._same_emotion_counter > self._mirrorEmotionDelta:
-                self._facialExpression.sendFaceExpression(emotion)
+                self._send_expression(emotion)
                 if self._voiceEnabled and time.time() > self._tts_end:
                     self.voice_reaction(emotion)
 
-    def update_GUI(self, frame, facePoints):
+    def _send_expression(self, expression):
+        """
+        Shows the given expression on the face unless it is already shown
+
+        :param expression: expression to show
+        :type expression: str
+        """
+        if expression != self._shown_exp:
+            self._facialExpression.sendFaceExpression(expression)
+            self._shown_exp = expression
+
+    def update_GUI(self, frame, facePoints, categoricalRecognition):
         """
         Updates gui with the detected face and corresponding emotion
 
@@ -369,12 +490,14 @@ class EmotionRecognition:
         :param facePoints: dict containing "top", "left", "bottom", "right"
                            points of the detected face
         :type facePoints: dict
+        :param categoricalRecognition: classification result for the face
+        :type categoricalRecognition: numpy.ndarray
         """
         frame = self._GUIController.createDetectedFacGUI(
             frame,
             facePoints,
             self._modelCategorical.modelDictionary,
-            self._categoricalRecognition,
+            categoricalRecognition,
         )
         # frame = self._GUIController.createDimensionalEmotionGUI(
         #     self._dimensionalRecognition,
@@ -383,55 +506,111 @@ class EmotionRecognition:
         #     self._modelCategorical.modelDictionary,
         # )
         frame = self._GUIController.createCategoricalEmotionGUI(
-            self._categoricalRecognition,
+            categoricalRecognition,
             frame,
             self._modelCategorical.modelDictionary,
             initialPosition=self._categoricalInitialPosition,
         )
         return frame
 
+    @staticmethod
+    def _put_latest(q, item):
+        """
+        Puts item into the given single slot queue, replacing any item that
+        was not consumed yet (the item is dropped if another producer filled
+        the queue in the meantime)
+
+        :param q: queue to put the item into
+        :type q: queue.Queue
+        :param item: item to put
+        """
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            q.put_nowait(item)
+        except queue.Full:
+            pass
+
     def _callback(self, rval, frame):
         """
-        Callback for the video device.
+        Callback for the video device. Detects and preprocesses the face and
+        hands it over to the inference thread.
 
         :param rval: rval
         :param frame: frame
         """
         if frame is not None:
             facePoints, face = self._imageProcessing.detectFace(frame)
+            if face is not None and len(face) > 0:
+                face = self._imageProcessing.preProcess(face, self._faceSize)
+            else:
+                face = None
+            self._put_latest(self._preQueue, (frame, facePoints, face))
 
-            if self._showGUI:
-                image = numpy.zeros(
-                    (self._finalImageSize[1], self._finalImageSize[0], 3), numpy.uint8
+    def _infer_loop(self):
+        """
+        Inference thread - classifies faces from the callback and hands the
+        results over to the post processing thread.
+        """
+        while self._running:
+            try:
+                frame, facePoints, face = self._preQueue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if face is not None:
+                self._categoricalRecognition = self._modelCategorical.classify(face)
+                # self._dimensionalRecognition = self._modelDimensional.classify(face)
+            else:
+                self._categoricalRecognition = None
+                self._dimensionalRecognition = None
+            self._put_latest(
+                self._postQueue, (frame, facePoints, self._categoricalRecognition)
+            )
+
+    def _tts_loop(self):
+        """
+        TTS thread - plays queued sentences so that speech synthesis does not
+        stall the other threads.
+        """
+        while self._running:
+            try:
+                sen, delay = self._ttsQueue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            # skip sentences queued while the previous one was generated
+            if time.time() > self._tts_end:
+                self.say(sen, delay)
+
+    def _post_loop(self):
+        """
+        Post processing thread - face tracking, emotion mirroring and GUI.
+        """
+        while self._running:
+            try:
+                frame, facePoints, categoricalRecognition = self._postQueue.get(
+                    timeout=0.1
                 )
-                image[0:480, 0:640] = frame
-                frame = image
+            except queue.Empty:
+                continue
 
-            if face is not None and len(face) > 0:
+            if categoricalRecognition is not None:
                 self._not_found_counter = 0
 
                 if self._faceTracking:
                     self.follow_face_with_head(facePoints)
 
-                face = self._imageProcessing.preProcess(face, self._faceSize)
-                with self._graph.as_default():
-                    self._categoricalRecognition = self._modelCategorical.classify(face)
-                    # self._dimensionalRecognition = self._modelDimensional.classify(face)
-
                 if self._mirrorEmotion and self._facialExpression is not None:
-                    expression = self.getHighestMatchingEmotion()
+                    expression = self._highest_matching_emotion(categoricalRecognition)
                     self.show_emotion(expression)
-
-                if self._showGUI:
-                    frame = self.update_GUI(frame, facePoints)
             else:
-                self._categoricalRecognition = None
-                self._dimensionalRecognition = None
                 if self._mirrorEmotion and self._facialExpression:
-                    self._facialExpression.sendFaceExpression("neutral")
+                    self._send_expression("neutral")
                 if self._faceTracking:
                     self._not_found_counter += 1
-                    self._logger.info("Saw nothing: %i", self._not_found_counter)
+                    if self._not_found_counter % 10 == 0:
+                        self._logger.debug("Saw nothing: %i", self._not_found_counter)
                     if self._not_found_counter > 50:
                         # After frames of not detecting something, return to
                         # mid position
@@ -449,9 +628,33 @@ class EmotionRecognition:
                                 + "skipping face tracking"
                             )
 
+            # all GUI work is skipped in headless mode
             if self._showGUI:
-                # Display the resulting frame
-                cv2.imshow("Visual Emotion Recognition", frame)
-                if cv2.waitKey(1) & 0xFF == ord("q"):
-                    # break
-                    return
+                self._show_GUI(frame, facePoints, categoricalRecognition)
+
+    def _show_GUI(self, frame, facePoints, categoricalRecognition):
+        """
+        Displays the camera frame with the GUI
+
+        :param frame: Current frame from the camera
+        :type frame: cv2.image
+        :param facePoints: dict containing "top", "left", "bottom", "right"
+                           points of the detected face
+        :type facePoints: dict
+        :param categoricalRecognition: classification result for the face (or
+                                       None if there is no face)
+        :type categoricalRecognition: numpy.ndarray
+        """
+        # clear the GUI drawn around the camera image in the last frame
+        self._canvas[:, 640:] = 0
+        self._canvas[480:, 0:640] = 0
+        numpy.copyto(self._canvas[0:480, 0:640], frame)
+        frame = self._canvas
+
+        if categoricalRecognition is not None:
+            frame = self.update_GUI(frame, facePoints, categoricalRecognition)
+
+        # Display the resulting frame
+        cv2.imshow("Visual Emotion Recognition", frame)
+        # needed for the window to refresh
+        self._pollKey()
@@ -1,3 +1,5 @@
+import logging
+
 import cv2
 import numpy
 import dlib
@@ -7,47 +9,151 @@ class imageProcessingUtil:
 
     faceDetectionMaximumFrequency = 10
 
+    # size of the thumbnails compared to decide if a frame changed enough
+    # since the last detection to run the face detector again
+    DIFF_SIZE = (80, 60)
+    # pixel difference in the thumbnails from which a pixel counts as moved
+    MOTION_THRESHOLD = 15
+    # margin added around the previous face when searching for it again
+    FACE_MARGIN = 0.2
+    # number of consecutive reuses of a detection after which the face
+    # detector runs again, so faces that left the frame are dropped even if
+    # the frame as a whole barely changed
+    MAX_CACHED_DETECTIONS = 2
+
     @property
     def faceDetector(self):
         return self._faceDetector
 
-    def __init__(self, faceDetectionMaximumFrequency=10):
+    def __init__(self, faceDetectionMaximumFrequency=10, diffThreshold=2.5):
 
+        self._logger = logging.getLogger(__name__)
         self._faceDetector = dlib.get_frontal_face_detector()
         self.faceDetectionMaximumFrequency = faceDetectionMaximumFrequency
+        # mean absolute pixel difference below which the previous detection
+        # is reused
+        self.diffThreshold = diffThreshold
+        self._detectionThumbnail = None
+        self._cacheHits = 0
+        self._cacheMisses = 0
+        self._consecutiveCacheHits = 0
 
     def preProcess(self, image, imageSize):
 
-        image = numpy.array(image)
-
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-        image = numpy.array(cv2.resize(image, imageSize))
-
-        image = numpy.expand_dims(image, axis=0)
-
-        image = image.astype("float32")
-
-        image /= 255
-
-        return image
-
-    previouslyDetectedface = None
-    currentFaceDetectionFrequency = -1
+        image = numpy.asarray(image)
+        # grayscale crops can be used as they are
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        # resize, convert to float32 and scale in a single call - returns a
+        # (1, 1, height, width) batch, of which the only sample is used
+        # opencv 3.x defaults to swapRB=True and crop=True
+        return cv2.dnn.blobFromImage(
+            image, 1 / 255.0, imageSize, swapRB=False, crop=False
+        )[0]
+
+    previouslyDetectedFace = []
+    # frames left until the face detection is refreshed
+    skipCountdown = 0
+
+    def resetFaceDetection(self):
+        # forces a new detection in the whole image on the next call of
+        # detectFace
+        self._detectionThumbnail = None
+        self._consecutiveCacheHits = 0
+        self.previouslyDetectedFace = []
+        self.skipCountdown = 0
+
+    def _searchArea(self, gray, difference):
+        # area around the previous face extended by the region that moved
+        # since the last detection (left, top, right, bottom)
+        previousFace = self.previouslyDetectedFace[0]
+        marginX = int(previousFace.width() * self.FACE_MARGIN)
+        marginY = int(previousFace.height() * self.FACE_MARGIN)
+        left = previousFace.left() - marginX
+        top = previousFace.top() - marginY
+        right = previousFace.right() + marginX
+        bottom = previousFace.bottom() + marginY
+
+        height, width = gray.shape
+        moved = cv2.findNonZero(
+            (difference > self.MOTION_THRESHOLD).astype(numpy.uint8)
+        )
+        if moved is not None:
+            x, y, w, h = cv2.boundingRect(moved)
+            scaleX = float(width) / self.DIFF_SIZE[0]
+            scaleY = float(height) / self.DIFF_SIZE[1]
+            left = min(left, int(x * scaleX))
+            top = min(top, int(y * scaleY))
+            right = max(right, int((x + w) * scaleX))
+            bottom = max(bottom, int((y + h) * scaleY))
+
+        return max(0, left), max(0, top), min(width, right), min(height, bottom)
+
+    def _detect(self, gray, difference):
+        # the whole image is only searched if there was no face before
+        if difference is None or len(self.previouslyDetectedFace) == 0:
+            return self.faceDetector(gray, 1)
+
+        left, top, right, bottom = self._searchArea(gray, difference)
+        if right <= left or bottom <= top:
+            return self.faceDetector(gray, 1)
+        dets = self.faceDetector(
+            numpy.ascontiguousarray(gray[top:bottom, left:right]), 1
+        )
+        if len(dets) == 0:
+            # face left the search area - look for it in the whole image
+            return self.faceDetector(gray, 1)
+        return [
+            dlib.rectangle(
+                d.left() + left, d.top() + top, d.right() + left, d.bottom() + top
+            )
+            for d in dets
+        ]
 
     def detectFace(self, image):
 
-        # print "CurrentFace:", self.currentFaceDetectionFrequency
-        if (
-            self.currentFaceDetectionFrequency == self.faceDetectionMaximumFrequency
-            or self.currentFaceDetectionFrequency == -1
-        ):
-            dets = self.faceDetector(image, 1)
-            self.previouslyDetectedFace = dets
-            self.currentFaceDetectionFrequency = 0
-        else:
+        if self.skipCountdown > 0:
             dets = self.previouslyDetectedFace
-            self.currentFaceDetectionFrequency = self.currentFaceDetectionFrequency + 1
+            self.skipCountdown -= 1
+        else:
+            # the grayscale image is shared by the thumbnail and the detector
+            if image.ndim == 3:
+                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            else:
+                gray = image
+            thumbnail = cv2.resize(gray, self.DIFF_SIZE)
+            difference = None
+            if self._detectionThumbnail is not None:
+                difference = cv2.absdiff(thumbnail, self._detectionThumbnail)
+            if (
+                difference is not None
+                and len(self.previouslyDetectedFace) > 0
+                and self._consecutiveCacheHits < self.MAX_CACHED_DETECTIONS
+                and numpy.mean(difference) < self.diffThreshold
+            ):
+                # frame barely changed since the last detection of a face -
+                # reuse it (missed faces are always searched again)
+                dets = self.previouslyDetectedFace
+                self._cacheHits += 1
+                self._consecutiveCacheHits += 1
+            else:
+                dets = self._detect(gray, difference)
+                self._consecutiveCacheHits = 0
+                self.previouslyDetectedFace = dets
+                self._detectionThumbnail = thumbnail
+                self._cacheMisses += 1
+            self._logger.debug(
+                "Face detection cache hits: %i, misses: %i",
+                self._cacheHits,
+                self._cacheMisses,
+            )
+            # keep looking every frame while there is no face, otherwise only
+            # refresh the detection every faceDetectionMaximumFrequency frames
+            if len(dets) > 0:
+                self.skipCountdown = self.faceDetectionMaximumFrequency
+            else:
+                self.skipCountdown = 0
 
         face = []
         dets_dict = {}
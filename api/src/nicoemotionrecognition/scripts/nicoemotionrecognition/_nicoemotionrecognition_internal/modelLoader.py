@@ -1,6 +1,10 @@
+import logging
+import multiprocessing
 import numpy
 import os
 
+import tensorflow as tf
+from keras import backend as K
 from keras.models import load_model
 
 from nicoemotionrecognition._nicoemotionrecognition_internal import (
@@ -11,13 +15,10 @@ from nicoemotionrecognition._nicoemotionrecognition_internal import (
 
 # os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 
-# from keras import backend as K
-
 
 class modelLoader:
 
     IMAGE_SIZE = (64, 64)
-    BATCH_SIZE = 32
 
     GPU = "/gpu:0"  #'/cpu:0'
 
@@ -33,12 +34,49 @@ class modelLoader:
     def dataLoader(self):
         return self._dataLoader
 
-    def __init__(self, modelDictionary):
+    @property
+    def backend(self):
+        return self._backend
 
+    @property
+    def tfliteDirectory(self):
+        return os.path.splitext(self.modelDictionary.modelDirectory)[0] + ".tflite"
+
+    @property
+    def onnxDirectory(self):
+        return os.path.splitext(self.modelDictionary.modelDirectory)[0] + ".onnx"
+
+    def __init__(self, modelDictionary, backend="keras"):
+
+        self._logger = logging.getLogger(__name__)
         self._modelDictionary = modelDictionary
         self._dataLoader = imageProcessingUtil.imageProcessingUtil()
-
-        self.loadModel()
+        self._model = None
+        self._interpreter = None
+        self._session = None
+
+        if backend == "tflite" and not os.path.isfile(self.tfliteDirectory):
+            self._logger.warning(
+                "No TFLite model found at '%s' (see "
+                "api/utility/quantize_emotion_model.py) - falling back to keras",
+                self.tfliteDirectory,
+            )
+            backend = "keras"
+        elif backend == "onnx" and not os.path.isfile(self.onnxDirectory):
+            self._logger.warning(
+                "No ONNX model found at '%s' (see "
+                "api/utility/export_emotion_model_onnx.py) - falling back to keras",
+                self.onnxDirectory,
+            )
+            backend = "keras"
+        self._backend = backend
+
+        if backend == "tflite":
+            self.loadTFLiteModel()
+        elif backend == "onnx":
+            self.loadONNXModel()
+        else:
+            self.loadModel()
 
     def loadModel(self):
 
@@ -52,9 +90,140 @@ class modelLoader:
             },
         )
         self._model.summary()
+        # classify is called from the inference thread, so the graph has to be
+        # made default there explicitly
+        self._graph = tf.get_default_graph()
+
+    def loadTFLiteModel(self):
+
+        try:
+            self._interpreter = tf.lite.Interpreter(
+                model_path=self.tfliteDirectory,
+                num_threads=multiprocessing.cpu_count(),
+            )
+        except TypeError:
+            # num_threads is only supported by tensorflow >= 2.4
+            self._interpreter = tf.lite.Interpreter(model_path=self.tfliteDirectory)
+        self._interpreter.allocate_tensors()
+        self._inputDetails = self._interpreter.get_input_details()[0]
+        self._outputDetails = self._interpreter.get_output_details()
+        self._logger.info("Loaded TFLite model '%s'", self.tfliteDirectory)
+
+    def loadONNXModel(self):
+
+        try:
+            import onnxruntime
+        except ImportError as e:
+            self._logger.warning(
+                "Failed to import onnxruntime. Make sure it is installed to use "
+                "the 'onnx' backend."
+            )
+            raise e
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self._session = onnxruntime.InferenceSession(
+            self.onnxDirectory, options, providers=["CPUExecutionProvider"]
+        )
+        self._sessionInput = self._session.get_inputs()[0].name
+        self._logger.info("Loaded ONNX model '%s'", self.onnxDirectory)
+
+    def convertToONNX(self, opset=13):
+
+        try:
+            import tf2onnx
+        except ImportError as e:
+            self._logger.warning(
+                "Failed to import tf2onnx. Make sure it is installed to export "
+                "the model."
+            )
+            raise e
+        session = K.get_session()
+        graphDef = tf.graph_util.convert_variables_to_constants(
+            session,
+            session.graph.as_graph_def(),
+            [tensor.op.name for tensor in self.model.outputs],
+        )
+        tf2onnx.convert.from_graph_def(
+            graphDef,
+            input_names=[tensor.name for tensor in self.model.inputs],
+            output_names=[tensor.name for tensor in self.model.outputs],
+            opset=opset,
+            output_path=self.onnxDirectory,
+        )
+        self._logger.info("Saved ONNX model to '%s'", self.onnxDirectory)
+
+    def convertToTFLite(self, representativeFaces=None, fp16=False):
+        # full integer quantization - representativeFaces (~100 preprocessed
+        # faces) are used to calibrate the activation ranges. With fp16, only
+        # the weights are stored as float16 and no calibration is needed.
+
+        if not fp16 and not representativeFaces:
+            raise ValueError("Full integer quantization requires representativeFaces")
+
+        def representativeDataset():
+            for face in representativeFaces:
+                yield [numpy.array([face], dtype=numpy.float32)]
+
+        converter = tf.lite.TFLiteConverter.from_session(
+            K.get_session(), self.model.inputs, self.model.outputs
+        )
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if fp16:
+            if not hasattr(converter.target_spec, "supported_types"):
+                raise RuntimeError(
+                    "float16 quantization requires tensorflow >= 1.15, found "
+                    + tf.__version__
+                )
+            converter.target_spec.supported_types = [tf.float16]
+        else:
+            converter.representative_dataset = tf.lite.RepresentativeDataset(
+                representativeDataset
+            )
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+            # tensorflow 1.x only supports uint8 as quantized input/output type
+            converter.inference_input_type = tf.uint8
+            converter.inference_output_type = tf.uint8
+
+        with open(self.tfliteDirectory, "wb") as f:
+            f.write(converter.convert())
+        self._logger.info("Saved TFLite model to '%s'", self.tfliteDirectory)
 
     def classify(self, image):
 
-        return self.model.predict(
-            numpy.array([image]), batch_size=self.BATCH_SIZE, verbose=0
+        if self._interpreter is not None:
+            return self._classifyTFLite(image)
+        if self._session is not None:
+            outputs = self._session.run(
+                None, {self._sessionInput: numpy.array([image], dtype=numpy.float32)}
+            )
+            # mirror keras, which only returns a list for multi-output models
+            return outputs[0] if len(outputs) == 1 else outputs
+
+        # a single face does not need predict's batching loop
+        with self._graph.as_default():
+            return self.model.predict_on_batch(numpy.array([image]))
+
+    def _classifyTFLite(self, image):
+
+        image = numpy.array([image], dtype=numpy.float32)
+        scale, zeroPoint = self._inputDetails["quantization"]
+        if scale:
+            image = numpy.round(image / scale + zeroPoint)
+            info = numpy.iinfo(self._inputDetails["dtype"])
+            image = numpy.clip(image, info.min, info.max)
+        self._interpreter.set_tensor(
+            self._inputDetails["index"], image.astype(self._inputDetails["dtype"])
         )
+        self._interpreter.invoke()
+
+        outputs = []
+        for details in self._outputDetails:
+            output = self._interpreter.get_tensor(details["index"])
+            scale, zeroPoint = details["quantization"]
+            if scale:
+                output = (output.astype(numpy.float32) - zeroPoint) * scale
+            outputs.append(output)
+        # mirror keras, which only returns a list for multi-output models
+        return outputs[0] if len(outputs) == 1 else outputs
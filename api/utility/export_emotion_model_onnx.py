@@ -0,0 +1,13 @@
+# export the categorical emotion model to ONNX for the 'onnx' backend
+# (requires tf2onnx)
+import keras.backend as K
+from nicoemotionrecognition._nicoemotionrecognition_internal import (
+    modelDictionary,
+    modelLoader,
+)
+
+# build inference graph without dropout
+K.set_learning_phase(0)
+
+model = modelLoader.modelLoader(modelDictionary.CategoricaModel)
+model.convertToONNX()
@@ -0,0 +1,63 @@
+# convert the categorical emotion model into an int8 quantized TFLite model,
+# calibrated on faces detected in the images of the given directory, or into a
+# float16 TFLite model (--fp16, no calibration images needed)
+import argparse
+import os
+
+import cv2
+import keras.backend as K
+from nicoemotionrecognition._nicoemotionrecognition_internal import (
+    imageProcessingUtil,
+    modelDictionary,
+    modelLoader,
+)
+
+parser = argparse.ArgumentParser(
+    description="Converts the emotion recognition model for the 'tflite' backend"
+)
+parser.add_argument(
+    "image_dir",
+    type=str,
+    nargs="?",
+    help="Directory with images of faces used for calibration",
+)
+parser.add_argument(
+    "--samples",
+    type=int,
+    default=100,
+    help="Maximum number of faces used for calibration (Default: 100)",
+)
+parser.add_argument(
+    "--fp16",
+    action="store_true",
+    help="Store weights as float16 instead of quantizing to int8",
+)
+args = parser.parse_args()
+if args.image_dir is None and not args.fp16:
+    parser.error("image_dir is required for int8 quantization")
+
+# build inference graph without dropout
+K.set_learning_phase(0)
+
+faces = []
+if not args.fp16:
+    imageProcessing = imageProcessingUtil.imageProcessingUtil()
+    for filename in sorted(os.listdir(args.image_dir)):
+        image = cv2.imread(os.path.join(args.image_dir, filename))
+        if image is None:
+            continue
+        # detect a new face in every image
+        imageProcessing.resetFaceDetection()
+        _, face = imageProcessing.detectFace(image)
+        if len(face) > 0:
+            faces.append(
+                imageProcessing.preProcess(face, modelLoader.modelLoader.IMAGE_SIZE)
+            )
+        if len(faces) >= args.samples:
+            break
+    if not faces:
+        parser.error("no faces detected in image_dir")
+    print("Calibrating with {} faces".format(len(faces)))
+
+model = modelLoader.modelLoader(modelDictionary.CategoricaModel)
+model.convertToTFLite(faces, fp16=args.fp16)